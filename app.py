@@ -1,12 +1,8 @@
 import streamlit as st
 
-import matplotlib
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-from shapely.geometry import box, LineString
-from PIL import Image
+from shapely.geometry import box
 import io
 import sys
 import traceback
@@ -85,101 +81,129 @@ network_type = st.sidebar.selectbox(
 )
 
 # --- 関数定義 ---
-def download_osm_data_safe(polygon, network_type, timeout=DOWNLOAD_TIMEOUT):
+@st.cache_data(show_spinner=False, persist="disk", max_entries=32)
+def fetch_graph(north, south, east, west, network_type, timeout=DOWNLOAD_TIMEOUT):
+    """OSMグラフ取得（範囲・種別ごとにキャッシュ）"""
+    import osmnx as ox
+    ox.settings.use_cache = True
+    # Overpassへのリクエストタイムアウト（osmnx 2.0で設定名が変更）
+    if hasattr(ox.settings, "requests_timeout"):
+        ox.settings.requests_timeout = timeout
+    else:
+        ox.settings.timeout = timeout
+    G = ox.graph_from_polygon(box(west, south, east, north), network_type=network_type, simplify=True, retain_all=False)
+
+    # MultiDiGraphはpickleが重いため、必要な列だけを表にして返す
+    gdf_nodes, gdf_edges = ox.graph_to_gdfs(G, node_geometry=False, fill_edge_geometry=False)
+    graph_nodes = pd.DataFrame(gdf_nodes[["y", "x"]])
+    graph_edges = pd.DataFrame(gdf_edges.reset_index()[["u", "v", "length"]])
+    return graph_nodes, graph_edges
+
+def download_osm_data_safe(north, south, east, west, network_type, timeout=DOWNLOAD_TIMEOUT):
     """OSMデータ安全取得"""
     try:
-        import osmnx as ox
-        G = ox.graph_from_polygon(polygon, network_type=network_type, simplify=True, retain_all=False)
-        return G
+        return fetch_graph(north, south, east, west, network_type, timeout)
     except Exception as e:
         st.error(f"OSM download failed: {e}")
         return None
 
-def convert_to_csv_data(G):
+def convert_to_csv_data(graph_nodes, graph_edges):
     """OSMノード・エッジをCSVデータ化（緯度経度ベース）"""
     try:
-        # ノード情報
-        nodes = []
-        node_id_map = {}
-        for i, (node_id, data) in enumerate(G.nodes(data=True), start=1):
-            nodes.append({
-                "ID": i,
-                "Latitude": data["y"],
-                "Longitude": data["x"],
-                "OSM_ID": node_id
-            })
-            node_id_map[node_id] = i
-        nodes_df = pd.DataFrame(nodes)
-
-        # エッジ情報
-        edges = []
-        for u, v, data in G.edges(data=True):
-            dist = data.get("length", 0)
-            edges.append({
-                "FromID": node_id_map[u],
-                "ToID": node_id_map[v],
-                "Distance": round(dist, 2)
-            })
-            # 双方向追加
-            edges.append({
-                "FromID": node_id_map[v],
-                "ToID": node_id_map[u],
-                "Distance": round(dist, 2)
-            })
-        edges_df = pd.DataFrame(edges)
+        # ノード情報（配列で一括変換）
+        n = len(graph_nodes)
+        osm_ids = graph_nodes.index.to_numpy()
+        nodes_df = pd.DataFrame({
+            "ID": np.arange(1, n + 1, dtype=np.int32),
+            "Latitude": graph_nodes["y"].to_numpy(),
+            "Longitude": graph_nodes["x"].to_numpy(),
+            "OSM_ID": osm_ids
+        })
+
+        # エッジ情報（ノード並び順をカテゴリにして連番IDへ変換し、双方向分を交互に並べて一括生成）
+        from_ids = pd.Categorical(graph_edges["u"], categories=osm_ids).codes.astype(np.int32) + 1
+        to_ids = pd.Categorical(graph_edges["v"], categories=osm_ids).codes.astype(np.int32) + 1
+        dists = np.array([round(d, 2) for d in graph_edges["length"].tolist()], dtype=np.float64)
+        edges_df = pd.DataFrame({
+            "FromID": np.column_stack([from_ids, to_ids]).ravel(),
+            "ToID": np.column_stack([to_ids, from_ids]).ravel(),
+            "Distance": np.repeat(dists, 2)
+        })
 
         return nodes_df, edges_df
     except Exception as e:
         st.error(f"CSV conversion failed: {e}")
         return pd.DataFrame(), pd.DataFrame()
 
-def generate_road_image(G):
-    """道路ネットワークを白背景で描画 (480x360)"""
-    try:
-        # ノード情報
-        node_data = [(data['x'], data['y']) for node, data in G.nodes(data=True)]
-        nodes_df = pd.DataFrame(node_data, columns=["Lon", "Lat"])
+def hash_dataframe(df):
+    """キャッシュキー用にDataFrameの列名と内容全体をハッシュ化"""
+    return tuple(df.columns), pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
 
-        # エッジ情報
-        edge_lines = []
-        for u, v, data in G.edges(data=True):
-            u_data = G.nodes[u]
-            v_data = G.nodes[v]
-            edge_lines.append(LineString([(u_data['x'], u_data['y']), (v_data['x'], v_data['y'])]))
+@st.cache_data(show_spinner=False, ttl=3600, hash_funcs={pd.DataFrame: hash_dataframe})
+def generate_road_image(nodes_df, edges_df):
+    """道路ネットワークを白背景で描画 (480x360, PNGバイト列を返す)"""
+    # 描画系ライブラリは初回描画時にのみ読み込む
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+    from PIL import Image
 
-        # 範囲設定
-        lon_min, lat_min, lon_max, lat_max = (
-            nodes_df["Lon"].min(),
-            nodes_df["Lat"].min(),
-            nodes_df["Lon"].max(),
-            nodes_df["Lat"].max(),
-        )
+    try:
+        # ノード座標（行番号 = ID - 1）
+        coords = nodes_df[["Longitude", "Latitude"]].to_numpy()
+
+        # エッジ情報（双方向の重複を除去し、IDで座標配列を直接参照）
+        from_ids = edges_df["FromID"].to_numpy()
+        to_ids = edges_df["ToID"].to_numpy()
+        key = (np.minimum(from_ids, to_ids).astype(np.int64) << 32) | np.maximum(from_ids, to_ids).astype(np.int64)
+        _, idx = np.unique(key, return_index=True)
+        from_xy = coords[from_ids[idx] - 1]
+        to_xy = coords[to_ids[idx] - 1]
+        segments = np.stack([from_xy, to_xy], axis=1)
 
-        # 図作成
-        fig, ax = plt.subplots(figsize=(480/72, 360/72), dpi=72)
-        ax.set_facecolor("white")
-        fig.patch.set_facecolor("white")
-        ax.axis("off")
-
-        # 道路描画
-        for line in edge_lines:
-            x, y = line.xy
-            ax.plot(x, y, color="black", linewidth=1.2, alpha=0.9)
-
-        ax.set_xlim(lon_min, lon_max)
-        ax.set_ylim(lat_min, lat_max)
-        plt.tight_layout(pad=0)
-
-        # 画像に変換
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png", dpi=72, bbox_inches="tight", pad_inches=0, facecolor="white")
-        buf.seek(0)
-        img = Image.open(buf).resize((480, 360), Image.Resampling.LANCZOS)
-        plt.close(fig)
-        return img
+        # 範囲設定
+        lon_min, lat_min = coords.min(axis=0)
+        lon_max, lat_max = coords.max(axis=0)
+
+        # 図作成（pyplotの図管理を通さず、480x360pxちょうどで描画）
+        fig = Figure(figsize=(480/72, 360/72), dpi=72, facecolor="white")
+        canvas = FigureCanvasAgg(fig)
+        try:
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.set_facecolor("white")
+            ax.axis("off")
+
+            # 道路描画（全エッジを1つのコレクションで描画）
+            ax.add_collection(LineCollection(segments, colors="black", linewidths=1.2, alpha=0.9))
+
+            ax.set_xlim(lon_min, lon_max)
+            ax.set_ylim(lat_min, lat_max)
+
+            # 画像に変換（Aggのバッファから直接パレットPNG用画像を生成）
+            canvas.draw()
+            rgba = np.asarray(canvas.buffer_rgba())
+            img = Image.fromarray(rgba).convert("RGB").quantize(colors=64, method=Image.Quantize.FASTOCTREE)
+        finally:
+            fig.clear()
     except Exception as e:
         st.error(f"Image generation failed: {e}")
-        return Image.new("RGB", (480, 360), color="white")
+        img = Image.new("RGB", (480, 360), color="white")
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=False, compress_level=1)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, ttl=3600, hash_funcs={pd.DataFrame: hash_dataframe})
+def to_csv_bytes(df):
+    """DataFrameをCSVバイト列に変換"""
+    return df.to_csv(index=False).encode("utf-8")
+
+@st.cache_data(show_spinner=False, ttl=3600, hash_funcs={pd.DataFrame: hash_dataframe})
+def to_parquet_bytes(df):
+    """DataFrameをParquetバイト列に変換（zstd圧縮）"""
+    buf = io.BytesIO()
+    df.to_parquet(buf, engine="pyarrow", compression="zstd", index=False)
+    return buf.getvalue()
 
 # --- メイン処理 ---
 st.header("📊 Data Acquisition and Conversion")
@@ -193,31 +217,31 @@ if st.button("🚀 Start Download & Conversion", type="primary", use_container_w
         st.stop()
 
     progress = st.progress(0)
-    polygon = box(west, south, east, north)
 
     progress.progress(10)
     st.info("📡 Downloading OSM data...")
-    G = download_osm_data_safe(polygon, network_type)
-    if G is None:
+    graph = download_osm_data_safe(north, south, east, west, network_type)
+    if graph is None:
         st.error("Download failed.")
         st.stop()
+    graph_nodes, graph_edges = graph
 
     progress.progress(50)
-    st.success(f"✅ Download complete: {len(G.nodes()):,} nodes, {len(G.edges()):,} edges")
+    st.success(f"✅ Download complete: {len(graph_nodes):,} nodes, {len(graph_edges):,} edges")
 
     progress.progress(70)
     st.info("🔄 Converting data to CSV format...")
-    nodes_df, edges_df = convert_to_csv_data(G)
+    nodes_df, edges_df = convert_to_csv_data(graph_nodes, graph_edges)
 
     progress.progress(80)
     st.info("🎨 Generating road network image...")
-    img = generate_road_image(G)
+    img_png = generate_road_image(nodes_df, edges_df)
 
     progress.progress(100)
     st.success("🎉 Conversion complete!")
 
     # 結果表示
-    st.image(img, caption="Road Network (480×360px, white background)", use_container_width=True)
+    st.image(img_png, caption="Road Network (480×360px, white background)", use_container_width=True)
 
     # CSVプレビュー
     with st.expander("📊 Node Data Preview"):
@@ -229,7 +253,7 @@ if st.button("🚀 Start Download & Conversion", type="primary", use_container_w
     st.subheader("📥 Download")
     col1, col2, col3 = st.columns(3)
     with col1:
-        node_csv = nodes_df.to_csv(index=False)
+        node_csv = to_csv_bytes(nodes_df)
         st.download_button(
             label="📥 Node CSV (Lat/Lon)",
             data=node_csv,
@@ -238,7 +262,7 @@ if st.button("🚀 Start Download & Conversion", type="primary", use_container_w
             use_container_width=True
         )
     with col2:
-        edge_csv = edges_df.to_csv(index=False)
+        edge_csv = to_csv_bytes(edges_df)
         st.download_button(
             label="📥 Edge CSV (FromID, ToID, Distance)",
             data=edge_csv,
@@ -247,15 +271,30 @@ if st.button("🚀 Start Download & Conversion", type="primary", use_container_w
             use_container_width=True
         )
     with col3:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
         st.download_button(
             label="📥 Road Network Image (PNG)",
-            data=buf.getvalue(),
+            data=img_png,
             file_name=f"{area_name}_RoadNetwork.png",
             mime="image/png",
             use_container_width=True
         )
+    col4, col5 = st.columns(2)
+    with col4:
+        st.download_button(
+            label="📥 Node Parquet",
+            data=to_parquet_bytes(nodes_df),
+            file_name=f"{area_name}_Nodes.parquet",
+            mime="application/vnd.apache.parquet",
+            use_container_width=True
+        )
+    with col5:
+        st.download_button(
+            label="📥 Edge Parquet",
+            data=to_parquet_bytes(edges_df),
+            file_name=f"{area_name}_Edges.parquet",
+            mime="application/vnd.apache.parquet",
+            use_container_width=True
+        )
 
 # Footer
 st.markdown("---")